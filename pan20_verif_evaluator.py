@@ -62,6 +62,16 @@ Example:
         -a "out/answers.jsonl" \
         -o "pan20-evaluation"
 
+To compare two systems on the same problems, pass the answers of the
+second system with `-b`. Instead of the point estimates, the script then
+writes `significance.json` with paired bootstrap confidence intervals and
+approximate randomization p-values for c@1, F0.5u and F1 (`-r` resamples,
+default 10000):
+
+>>> python pan20_verif_evaluator.py -i "datasets/test_truth/truth.jsonl" \
+        -a "out/answers.jsonl" -b "out2/answers.jsonl" \
+        -o "pan20-evaluation"
+
 ## References
 - E. Stamatatos, et al. Overview of the Author Identification
   Task at PAN 2014. CLEF Working Notes (2014): 877-897.
@@ -290,6 +300,222 @@ def evaluate_all(true_y, pred_y):
     return results
 
 
+# Columns of the indicator matrix built by `indicators`
+INDICATORS = ['c1_correct', 'c1_unanswered', 'f05_tp', 'f05_fp', 'f05_fn',
+              'f1_tp', 'f1_fp', 'f1_fn']
+
+SIGNIFICANCE_METRICS = ['c_at_1', 'f_05_u', 'f1']
+
+
+def indicators(true_y, pred_y):
+    """
+    Builds the per-problem 0/1 indicators that c@1, F0.5u and F1 are
+    computed from (see `INDICATORS`). The metrics of any resample of the
+    problems are then functions of `weights @ indicators`, which lets
+    thousands of resamples be evaluated in one matrix product.
+    The indicators follow `c_at_1`, `f_05_u_score` and `f1` above, so
+    `metrics_from_counts(indicators(t, p).sum(axis=0), len(t))` gives
+    the same values as `evaluate_all`.
+
+    Parameters
+    ----------
+    true_y : array [n_problems]
+        The gold annotations, `0` or `1`.
+
+    pred_y : array [n_problems]
+        The predictions, `0 >= prediction <= 1`.
+
+    Returns
+    ----------
+    ind = array [n_problems, len(INDICATORS)] of floats.
+    """
+    true_y = np.asarray(true_y, dtype=np.float64)
+    pred_y = np.asarray(pred_y, dtype=np.float64)
+    answered = pred_y != 0.5
+    pos = true_y == 1
+    # f_05_u_score binarizes first, so 0.5 counts as a positive answer
+    pred_pos = pred_y >= 0.5
+    pred_pos_answered = pred_y > 0.5
+    ind = np.stack([
+        answered & ((pred_y > 0.5) == (true_y > 0.5)),
+        ~answered,
+        pred_pos & pos,
+        pred_pos & ~pos,
+        ~pred_pos & pos,
+        answered & pred_pos_answered & pos,
+        answered & pred_pos_answered & ~pos,
+        answered & ~pred_pos_answered & pos,
+    ], axis=1)
+    return ind.astype(np.float64)
+
+
+def _ratio(num, den):
+    num, den = np.broadcast_arrays(np.asarray(num, dtype=np.float64),
+                                   np.asarray(den, dtype=np.float64))
+    out = np.zeros(num.shape)
+    np.divide(num, den, out=out, where=den != 0)
+    return out
+
+
+def metrics_from_counts(counts, n):
+    """
+    Calculates c@1, F0.5u and F1 from summed indicators.
+
+    Parameters
+    ----------
+    counts : array [..., len(INDICATORS)]
+        Sums of `indicators` over (resampled) problems.
+
+    n : int
+        The number of (resampled) problems.
+
+    Returns
+    ----------
+    metrics = dict of arrays [...], one per name in `SIGNIFICANCE_METRICS`.
+    """
+    c = {name: counts[..., i] for i, name in enumerate(INDICATORS)}
+    nc, nu = c['c1_correct'], c['c1_unanswered']
+    return {
+        'c_at_1': (nc + nu * nc / n) / n,
+        'f_05_u': _ratio(1.25 * c['f05_tp'],
+                         1.25 * c['f05_tp'] + 0.25 * c['f05_fn'] + c['f05_fp']),
+        'f1': _ratio(2 * c['f1_tp'],
+                     2 * c['f1_tp'] + c['f1_fp'] + c['f1_fn']),
+    }
+
+
+def paired_bootstrap(true_y, pred_a, pred_b, n_resamples=10000, alpha=0.05,
+                     batch_size=1000, seed=0):
+    """
+    Paired bootstrap of c@1, F0.5u and F1 for two systems answering the
+    same problems. Both systems are evaluated on the same resamples;
+    each batch of resamples is drawn as a matrix of multinomial counts
+    and evaluated in one matrix product.
+
+    Parameters
+    ----------
+    true_y : array [n_problems]
+        The gold annotations.
+
+    pred_a, pred_b : array [n_problems]
+        The predictions of the two systems.
+
+    n_resamples : int
+        Number of bootstrap resamples.
+
+    alpha : float
+        The confidence intervals cover `1 - alpha`.
+
+    batch_size : int
+        Resamples evaluated per matrix product (memory is
+        `batch_size * n_problems` counts).
+
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    ----------
+    results = dict per metric with the point estimates `a`, `b`,
+        `diff` (a - b), their percentile confidence intervals `ci_a`,
+        `ci_b`, `ci_diff` and the two-sided bootstrap `p_value` of
+        diff != 0.
+    """
+    rng = np.random.default_rng(seed)
+    ind_a = indicators(true_y, pred_a)
+    ind_b = indicators(true_y, pred_b)
+    n = len(ind_a)
+    point_a = metrics_from_counts(ind_a.sum(axis=0), n)
+    point_b = metrics_from_counts(ind_b.sum(axis=0), n)
+
+    samples_a = {m: [] for m in SIGNIFICANCE_METRICS}
+    samples_b = {m: [] for m in SIGNIFICANCE_METRICS}
+    for start in range(0, n_resamples, batch_size):
+        size = min(batch_size, n_resamples - start)
+        weights = rng.multinomial(n, np.full(n, 1.0 / n), size=size)
+        ma = metrics_from_counts(weights @ ind_a, n)
+        mb = metrics_from_counts(weights @ ind_b, n)
+        for m in SIGNIFICANCE_METRICS:
+            samples_a[m].append(ma[m])
+            samples_b[m].append(mb[m])
+
+    q = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    results = {}
+    for m in SIGNIFICANCE_METRICS:
+        sa = np.concatenate(samples_a[m])
+        sb = np.concatenate(samples_b[m])
+        diff = sa - sb
+        p_value = 2 * min(np.mean(diff <= 0), np.mean(diff >= 0))
+        results[m] = {'a': float(point_a[m]), 'b': float(point_b[m]),
+                      'diff': float(point_a[m] - point_b[m]),
+                      'ci_a': np.percentile(sa, q).tolist(),
+                      'ci_b': np.percentile(sb, q).tolist(),
+                      'ci_diff': np.percentile(diff, q).tolist(),
+                      'p_value': float(min(p_value, 1.0))}
+    return results
+
+
+def approximate_randomization(true_y, pred_a, pred_b, n_resamples=10000,
+                              batch_size=1000, seed=0):
+    """
+    Approximate randomization test of c@1, F0.5u and F1 for two systems
+    answering the same problems. In every resample the answers of the
+    two systems are swapped on a random half of the problems; a batch
+    of swap masks is evaluated in one matrix product.
+
+    Parameters
+    ----------
+    see `paired_bootstrap`
+
+    Returns
+    ----------
+    results = dict per metric with the observed `diff` (a - b) and the
+        `p_value` of a difference at least as large as observed, with
+        the usual +1 correction.
+    """
+    rng = np.random.default_rng(seed)
+    ind_a = indicators(true_y, pred_a)
+    ind_b = indicators(true_y, pred_b)
+    n = len(ind_a)
+    sum_a = ind_a.sum(axis=0)
+    sum_b = ind_b.sum(axis=0)
+    delta = ind_b - ind_a
+    observed = {m: abs(v_a - v_b) for (m, v_a), v_b in
+                zip(metrics_from_counts(sum_a, n).items(),
+                    metrics_from_counts(sum_b, n).values())}
+
+    hits = {m: 0 for m in SIGNIFICANCE_METRICS}
+    for start in range(0, n_resamples, batch_size):
+        size = min(batch_size, n_resamples - start)
+        swap = rng.integers(0, 2, size=(size, n)).astype(np.float64)
+        moved = swap @ delta
+        ma = metrics_from_counts(sum_a + moved, n)
+        mb = metrics_from_counts(sum_b - moved, n)
+        for m in SIGNIFICANCE_METRICS:
+            # tolerance for float round-off on ties
+            hits[m] += int(np.sum(np.abs(ma[m] - mb[m]) >= observed[m] - 1e-12))
+
+    point_a = metrics_from_counts(sum_a, n)
+    point_b = metrics_from_counts(sum_b, n)
+    return {m: {'diff': float(point_a[m] - point_b[m]),
+                'p_value': (hits[m] + 1) / (n_resamples + 1)}
+            for m in SIGNIFICANCE_METRICS}
+
+
+def align(gt, pred):
+    """
+    Aligns loaded ground truth and answers by problem id, defaulting
+    missing answers to 0.5. Returns two arrays sorted by id.
+    """
+    pred = dict(pred)
+    for probl_id in sorted(gt):
+        if probl_id not in pred:
+            pred[probl_id] = 0.5
+    assert set(gt.keys()).union(set(pred)) == set(gt.keys())
+    scores = [(gt[k], pred[k]) for k in sorted(gt)]
+    gt, pred = zip(*scores)
+    return np.array(gt, dtype=np.float64), np.array(pred, dtype=np.float64)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Evaluation script AA@PAN2020')
     parser.add_argument('-i', type=str,
@@ -298,6 +524,11 @@ def main():
                         help='Path to the jsonl-file with the answers (system prediction)')
     parser.add_argument('-o', type=str, 
                         help='Path to output files')
+    parser.add_argument('-b', type=str,
+                        help='Path to the answers of a second system; compares both with '
+                             'paired bootstrap and approximate randomization')
+    parser.add_argument('-r', type=int, default=10000,
+                        help='Number of resamples for the comparison (default 10000)')
     args = parser.parse_args()
 
     # validate:
@@ -307,6 +538,18 @@ def main():
         raise ValueError('The answers path is required')
     if not args.o:
         raise ValueError('The output folder path is required')
+
+    if args.b:
+        gt = load_file(args.i)
+        gt_y, pred_a = align(gt, load_file(args.a))
+        _, pred_b = align(gt, load_file(args.b))
+        results = {'bootstrap': paired_bootstrap(gt_y, pred_a, pred_b, args.r),
+                   'randomization': approximate_randomization(gt_y, pred_a, pred_b, args.r),
+                   'resamples': args.r}
+        print(json.dumps(results, indent=4))
+        with open(args.o + os.sep + 'significance.json', 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        return
     
     # load:
     gt = load_file(args.i)
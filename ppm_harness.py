@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ Differential correctness harness for the PPM implementation of teahan03.py.
+
+ Every registered implementation computes the cross-entropy of a text2
+ using the model of a text1. The harness runs all implementations on
+ generated corpora (random, repetitive, IPA, NUL, empty and 1-character
+ texts) and checks that they give the same cross-entropy as the reference
+ implementation (Model.read + h) within a tolerance. If the reference
+ raises an exception (e.g. on an empty text2), the implementation must
+ raise the same exception type. Every implementation is timed in the
+ same run.
+
+ The distance() features of every pair are checked the same way against
+ the other distance paths (batch_distance, distance(sparse=True)). The
+ features are rounded to 4 decimals, so they may differ by one unit of
+ the rounding.
+
+ New implementations are added with the register decorator:
+
+    @register('my_engine')
+    def my_engine(text1, text2, ppm_order):
+        ...
+        return cross_entropy
+
+ and new distance paths with register_distance, returning the two features.
+
+ Usage from command line:
+    > python ppm_harness.py [-p PPM-ORDER] [-n LENGTH] [-s SEEDS] [-t TOL]
+ The exit status is 1 if any implementation disagrees with the reference.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from teahan03 import CountTables, Model, batch_distance, build_models, \
+    distance, h, h_segments, segments
+
+
+# name -> function(text1, text2, ppm_order) returning the cross-entropy of
+# text2 using the model of text1
+IMPLEMENTATIONS = {}
+
+# name -> function(text1, text2, ppm_order) returning distance(text1, text2)
+DISTANCES = {}
+
+REFERENCE = 'reference'
+DISTANCE_REFERENCE = 'distance'
+
+# largest accepted difference of the distance features, rounded to 4 decimals
+DISTANCE_TOLERANCE = 1e-4 + 1e-9
+
+IPA = 'aæɑɒʌbβcçdðeəɛɜfɡɣhɦiɪjʝklɫɬmɱnŋɲoɔøœpɸrɹɾʁsʃtθuʊʉvʋwxχyʏzʒʔːˈˌ '
+
+
+def register(name):
+    def decorator(fn):
+        IMPLEMENTATIONS[name] = fn
+        return fn
+    return decorator
+
+
+def register_distance(name):
+    def decorator(fn):
+        DISTANCES[name] = fn
+        return fn
+    return decorator
+
+
+@register(REFERENCE)
+def reference(text1, text2, ppm_order):
+    m = Model(ppm_order, 256)
+    m.read(text1)
+    return h(m, text2)
+
+
+@register('chunked')
+def chunked(text1, text2, ppm_order):
+    m = Model(ppm_order, 256)
+    # segments shorter than the PPM orders checked, so the context is
+    # carried over several segment boundaries
+    m.readChunks(segments([text1], 3))
+    return h_segments(m, [text2], 4)[0]
+
+
+@register('sparse')
+def sparse(text1, text2, ppm_order):
+    m = Model(ppm_order, 256)
+    m.read(text1, m.queryContexts(text2))
+    return h(m, text2)
+
+
+@register('merge_negate')
+def merge_negate(text1, text2, ppm_order):
+    # merge the models of text1 and text2, then negate the model of text2
+    m = Model(ppm_order, 256)
+    for text in (text1, text2):
+        part = Model(ppm_order, 256)
+        part.read(text)
+        m.merge(part)
+    other = Model(ppm_order, 256)
+    other.read(text2)
+    m.negate(other)
+    return h(m, text2)
+
+
+@register('sketch')
+def sketch(text1, text2, ppm_order):
+    # exact as long as the sketch has no collisions on these small corpora
+    m = Model(ppm_order, 256, sketchOrder=min(3, ppm_order), epsilon=1e-4)
+    m.read(text1)
+    return h(m, text2)
+
+
+@register('numpy_batch')
+def numpy_batch(text1, text2, ppm_order):
+    m = build_models([text2, text1], ppm_order, 256)[1]
+    return h(m, text2)
+
+
+@register('numpy_tables')
+def numpy_tables(text1, text2, ppm_order):
+    return CountTables([text1, text2], ppm_order).crossEntropy(0, 1, 256)
+
+
+@register_distance(DISTANCE_REFERENCE)
+def distance_reference(text1, text2, ppm_order):
+    return distance(text1, text2, ppm_order)
+
+
+@register_distance('batch_distance')
+def batch(text1, text2, ppm_order):
+    # the pair shares its count tables with another pair of the batch
+    return batch_distance([(text2, text1 + text2), (text1, text2)],
+                          ppm_order)[1]
+
+
+@register_distance('distance_sparse')
+def distance_sparse(text1, text2, ppm_order):
+    return distance(text1, text2, ppm_order, sparse=True)
+
+
+# Returns a list of (name, text1, text2) pairs
+def corpora(length=500, seed=0):
+    rs = random.Random(seed)
+    latin = 'abcdefghijklmnopqrstuvwxyz ,.'
+
+    def rand(alphabet, n):
+        return ''.join(rs.choice(alphabet) for _ in range(n))
+
+    def repetitive(n):
+        pattern = rand(latin, rs.randint(2, 8))
+        s = list((pattern * (n // len(pattern) + 1))[:n])
+        for _ in range(n // 50):
+            s[rs.randrange(n)] = rs.choice(latin)
+        return ''.join(s)
+
+    return [
+        ('random', rand(latin, length), rand(latin, length)),
+        ('random_disjoint', rand('abcde', length), rand('vwxyz', length)),
+        ('repetitive', repetitive(length), repetitive(length)),
+        ('ipa', rand(IPA, length), rand(IPA, length)),
+        ('ipa_vs_latin', rand(IPA, length), rand(latin, length)),
+        ('nul', rand('ab\x00c', length), rand('ab\x00', length)),
+        ('empty_model', '', rand(latin, length)),
+        ('empty_query', rand(latin, length), ''),
+        ('empty_both', '', ''),
+        ('one_char', rand(latin, 1), rand(latin, 1)),
+        ('one_char_model', rand(latin, 1), rand(latin, length)),
+        ('one_char_query', rand(latin, length), rand(latin, 1)),
+    ]
+
+
+# calls fn and returns its result or the exception it raised
+def run(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as e:
+        return e
+
+
+# Runs all implementations on the corpora and compares them to the reference
+# Returns the list of mismatches and the time spent by each implementation
+def check(ppm_orders=(0, 1, 2, 5), length=500, seeds=(0, 1, 2), tol=1e-9,
+          implementations=None, reference=None):
+    implementations = implementations or IMPLEMENTATIONS
+    reference = reference or IMPLEMENTATIONS[REFERENCE]
+    timings = {name: 0.0 for name in implementations}
+    mismatches = []
+    for seed in seeds:
+        for case, text1, text2 in corpora(length, seed):
+            for ppm_order in ppm_orders:
+                expected = run(reference, text1, text2, ppm_order)
+                for name, fn in implementations.items():
+                    start = time.perf_counter()
+                    got = run(fn, text1, text2, ppm_order)
+                    timings[name] += time.perf_counter() - start
+                    if isinstance(expected, Exception) or isinstance(got, Exception):
+                        ok = type(expected) is type(got)
+                    elif isinstance(expected, list):
+                        ok = len(expected) == len(got) and all(
+                            abs(e - g) <= tol for e, g in zip(expected, got))
+                    else:
+                        ok = abs(expected - got) <= tol
+                    if not ok:
+                        mismatches.append({'implementation': name,
+                                           'case': case, 'seed': seed,
+                                           'ppm_order': ppm_order,
+                                           'expected': repr(expected),
+                                           'got': repr(got)})
+    return mismatches, timings
+
+
+# Same as check() for the distance paths
+def check_distances(ppm_orders=(0, 1, 2, 5), length=500, seeds=(0, 1, 2),
+                    tol=DISTANCE_TOLERANCE, distances=None):
+    return check(ppm_orders, length, seeds, tol, distances or DISTANCES,
+                 DISTANCES[DISTANCE_REFERENCE])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Differential correctness harness for PPM implementations')
+    parser.add_argument('-p', '--ppm_orders', type=int, nargs='+',
+                        default=[0, 1, 2, 5],
+                        help='Prediction by Partial Matching orders to check')
+    parser.add_argument('-n', '--length', type=int, default=500,
+                        help='Length of the generated texts')
+    parser.add_argument('-s', '--seeds', type=int, default=3,
+                        help='Number of generated corpora')
+    parser.add_argument('-t', '--tolerance', type=float, default=1e-9,
+                        help='Largest accepted difference to the reference')
+    parser.add_argument('-e', '--engines', type=str, nargs='+',
+                        default=sorted(IMPLEMENTATIONS) + sorted(DISTANCES),
+                        help='Implementations and distance paths to check')
+    args = parser.parse_args()
+
+    implementations = {name: IMPLEMENTATIONS[name] for name in args.engines
+                       if name in IMPLEMENTATIONS}
+    distances = {name: DISTANCES[name] for name in args.engines
+                 if name in DISTANCES}
+    mismatches, timings = [], {}
+    if implementations:
+        mismatches, timings = check(args.ppm_orders, args.length,
+                                    range(args.seeds), args.tolerance,
+                                    implementations)
+    if distances:
+        found, times = check_distances(args.ppm_orders, args.length,
+                                       range(args.seeds),
+                                       max(args.tolerance, DISTANCE_TOLERANCE),
+                                       distances)
+        mismatches += found
+        timings.update(times)
+
+    for name in sorted(timings, key=timings.get):
+        failed = len([m for m in mismatches if m['implementation'] == name])
+        print('%-16s %8.3f s  %s' % (name, timings[name],
+                                     'FAILED (%d)' % failed if failed else 'ok'))
+    for m in mismatches:
+        print(m)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
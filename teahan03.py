@@ -75,14 +75,25 @@ import os
 import json
 import time
 import argparse
-from statistics import mean
-
-import numpy as np
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import StratifiedKFold
-from joblib import dump, load
-from tqdm import tqdm
-from pan20_verif_evaluator import evaluate_all
+import bz2
+import hashlib
+import heapq
+import lzma
+import math
+import struct
+import sys
+import zlib
+from array import array
+from itertools import islice
+
+# numpy, sklearn, joblib, tqdm, statistics and the evaluator are imported
+# inside the functions that need them. The CLI is called thousands of times
+# from batch scripts, so `--help` and `prep` must not pay for loading sklearn.
+# Target: `python teahan03.py --help` takes at most STARTUP_TARGET seconds
+# more than a bare interpreter start (about 40 ms measured, more than half
+# of it compiling this script, which Python never caches when run as __main__).
+# Both are checked by test_teahan03.py.
+STARTUP_TARGET = 0.1
 
 
 class Model(object):
@@ -90,34 +101,109 @@ class Model(object):
     # modelOrder - order of the model
     # orders - List of Order-Objects
     # alphSize - size of the alphabet
-    def __init__(self, order, alphSize):
+    # backoffs - histogram of backoff depths in h() or None, see trackBackoffs
+    # sketchOrder - lowest order counted in the sketch, None if all orders
+    #   are counted exactly
+    # sketch - CountMinSketch shared by all orders >= sketchOrder
+    def __init__(self, order, alphSize, sketchOrder=None, epsilon=1e-5,
+                 delta=0.01):
         self.cnt = 0
         self.alphSize = alphSize
         self.modelOrder = order
+        self.sketchOrder = None
+        self.sketch = None
+        self.backoffs = None
+        # order that answered the last p(), -1 for the uniform fallback
+        self.answered = None
+        if sketchOrder is not None and sketchOrder <= order:
+            self.sketchOrder = sketchOrder
+            self.sketch = CountMinSketch(epsilon, delta)
         self.orders = []
         for i in range(order + 1):
-            self.orders.append(Order(i))
-
-    # print the model
-    # TODO: Output becomes too long, reordering on the screen has to be made
-    def printModel(self):
-        s = "Total characters read: " + str(self.cnt) + "\n"
+            if self.sketch is not None and i >= sketchOrder:
+                self.orders.append(SketchOrder(i, self.sketch))
+            else:
+                self.orders.append(Order(i))
+
+    # estimated memory footprint of the model counts in bytes
+    def memorySize(self):
+        size = sum(o.memorySize() for o in self.orders)
+        if self.sketch is not None:
+            size += self.sketch.memorySize()
+        return size
+
+    # returns statistics of the model: characters read, estimated memory,
+    # and per order the number of contexts, distinct symbols, distinct
+    # (context, symbol) entries and total count. If backoffs are tracked
+    # (see trackBackoffs), the histogram of backoff depths seen by h() is
+    # included. Orders counted in a sketch report None for what the sketch
+    # cannot enumerate
+    def stats(self, memory=True):
+        orders = []
+        for o in self.orders:
+            if isinstance(o, SketchOrder):
+                orders.append({'order': o.n, 'contexts': None, 'symbols': None,
+                               'entries': None, 'count': o.cnt})
+                continue
+            symbols = set()
+            entries = 0
+            for context in o.contexts.values():
+                symbols.update(context.chars)
+                entries += len(context.chars)
+            orders.append({'order': o.n, 'contexts': len(o.contexts),
+                           'symbols': len(symbols), 'entries': entries,
+                           'count': o.cnt})
+        st = {'characters': self.cnt, 'orders': orders}
+        if memory:
+            st['memory'] = self.memorySize()
+        if self.backoffs is not None:
+            st['backoffs'] = dict(sorted(self.backoffs.items()))
+        return st
+
+    # start collecting the histogram of backoff depths in h(): how many
+    # orders below the full context each prediction was answered,
+    # len(context) + 1 meaning the uniform fallback 1 / alphSize
+    def trackBackoffs(self):
+        self.backoffs = {}
+
+    # returns up to limit contexts of order n, skipping the first offset, as
+    # (context, count, [(symbol, count), ...]) with the symbols by count.
+    # With top=True the contexts are the most frequent ones, otherwise in
+    # insertion order (cheap for paging through large orders)
+    def dumpOrder(self, n, offset=0, limit=20, top=True):
+        o = self.orders[n]
+        if isinstance(o, SketchOrder):
+            return []
+        if top:
+            items = heapq.nlargest(offset + limit, o.contexts.items(),
+                                   key=lambda item: item[1].cnt)[offset:]
+        else:
+            items = islice(o.contexts.items(), offset, offset + limit)
+        return [(cont, context.cnt,
+                 sorted(context.chars.items(), key=lambda c: -c[1]))
+                for cont, context in items]
+
+    # print the statistics and the most frequent contexts of every order
+    def printModel(self, limit=10, symbols=None):
+        st = self.stats()
+        print("Total characters read: " + str(st['characters']))
+        print("Estimated memory: " + str(st['memory']) + " bytes")
+        if 'backoffs' in st:
+            print("Backoff depths: " + str(st['backoffs']))
         for i in range(self.modelOrder + 1):
-            self.printOrder(i)
+            self.printOrder(i, limit=limit, symbols=symbols)
 
-    # print a specific order of the model
-    # TODO: Output becomes too long, reordering on the screen has to be made
-    def printOrder(self, n):
+    # print one page of limit contexts of a specific order with up to symbols
+    # of their most frequent symbols (all if None)
+    def printOrder(self, n, offset=0, limit=10, top=True, symbols=None):
         o = self.orders[n]
-        s = "Order " + str(n) + ": (" + str(o.cnt) + ")\n"
-        for cont in o.contexts:
-            if (n > 0):
-                s += "  '" + cont + "': (" + str(o.contexts[cont].cnt) + ")\n"
-            for char in o.contexts[cont].chars:
-                s += "     '" + char + "': " + \
-                     str(o.contexts[cont].chars[char]) + "\n"
-        s += "\n"
-        print(s)
+        print("Order " + str(n) + ": (" + str(o.cnt) + ")")
+        if isinstance(o, SketchOrder):
+            print("  (counted in sketch)")
+        for cont, cnt, chars in self.dumpOrder(n, offset, limit, top):
+            print("  '" + cont + "': (" + str(cnt) + ") " +
+                  " ".join("'%s': %d" % c for c in chars[:symbols]))
+        print("")
 
     # updates the model with a character c in context cont
     def update(self, c, cont):
@@ -125,12 +211,15 @@ class Model(object):
             raise NameError("Context is longer than model order!")
 
         order = self.orders[len(cont)]
-        if not order.hasContext(cont):
-            order.addContext(cont)
-        context = order.contexts[cont]
-        if not context.hasChar(c):
-            context.addChar(c)
-        context.incCharCount(c)
+        if isinstance(order, SketchOrder):
+            order.add(c, cont)
+        else:
+            if not order.hasContext(cont):
+                order.addContext(cont)
+            context = order.contexts[cont]
+            if not context.hasChar(c):
+                context.addChar(c)
+            context.incCharCount(c)
         order.cnt += 1
         if (order.n > 0):
             self.update(c, cont[1:])
@@ -138,9 +227,13 @@ class Model(object):
             self.cnt += 1
 
     # updates the model with a string
-    def read(self, s):
+    # if keep is given, only contexts in keep are counted, see queryContexts
+    def read(self, s, keep=None):
         if (len(s) == 0):
             return
+        if keep is not None:
+            self.readSparse(s, keep)
+            return
         for i in range(len(s)):
             cont = ""
             if (i != 0 and i - self.modelOrder <= 0):
@@ -149,22 +242,86 @@ class Model(object):
                 cont = s[i - self.modelOrder:i]
             self.update(s[i], cont)
 
+    # updates the model with a string, counting only the contexts in keep.
+    # keep is closed under suffixes, so the orders are walked upwards and
+    # the walk stops at the first context not in keep; characters whose
+    # order 1 context is not shared with the query cost one set lookup
+    def readSparse(self, s, keep):
+        orders = self.orders
+        for i in range(len(s)):
+            c = s[i]
+            for k in range(min(i, self.modelOrder) + 1):
+                cont = s[i - k:i]
+                if cont not in keep:
+                    break
+                order = orders[k]
+                if isinstance(order, SketchOrder):
+                    order.add(c, cont)
+                    continue
+                context = order.contexts.get(cont)
+                if context is None:
+                    context = order.contexts[cont] = Context()
+                context.chars[c] = context.chars.get(c, 0) + 1
+                context.cnt += 1
+        # the counts update() keeps for every order
+        for order in orders:
+            order.cnt += max(len(s) - order.n, 0)
+        self.cnt += len(s)
+
+    # returns the set of contexts (including backoff suffixes) that h(m, s)
+    # looks up in a model of this order. A model read with this set as keep
+    # gives the same h(m, s) as the full model, but only stores the contexts
+    # shared by both texts. The set itself holds the distinct contexts of s
+    # up to this order, so it only saves memory when the other text is
+    # longer or more varied than s
+    def queryContexts(self, s):
+        keep = set()
+        for i in range(len(s)):
+            for j in range(max(0, i - self.modelOrder), i + 1):
+                keep.add(s[j:i])
+        return keep
+
+    # updates the model with an iterable of strings, as if they were read
+    # as one string; only the last modelOrder characters are kept between
+    # chunks, so memory does not depend on the length of the text
+    def readChunks(self, chunks):
+        history = ""
+        for chunk in chunks:
+            s = history + chunk
+            for i in range(len(history), len(s)):
+                self.update(s[i], s[max(0, i - self.modelOrder):i])
+            history = s[max(0, len(s) - self.modelOrder):]
+
     # return the models probability of character c in content cont
     def p(self, c, cont):
         if len(cont) > self.modelOrder:
             raise NameError("Context is longer than order!")
 
         order = self.orders[len(cont)]
+        if isinstance(order, SketchOrder):
+            total = order.contextCount(cont)
+            count = order.charCount(c, cont) if total > 0 else 0
+            if count == 0:
+                if (order.n == 0):
+                    self.answered = -1
+                    return 1.0 / self.alphSize
+                return self.p(c, cont[1:])
+            self.answered = order.n
+            return float(min(count, total)) / total
+
         if not order.hasContext(cont):
             if (order.n == 0):
+                self.answered = -1
                 return 1.0 / self.alphSize
             return self.p(c, cont[1:])
 
         context = order.contexts[cont]
         if not context.hasChar(c):
             if (order.n == 0):
+                self.answered = -1
                 return 1.0 / self.alphSize
             return self.p(c, cont[1:])
+        self.answered = order.n
         return float(context.getCharCount(c)) / context.cnt
 
     # merge this model with another model m, esentially the values for every
@@ -174,6 +331,10 @@ class Model(object):
             raise NameError("Models must have the same order to be merged")
         if self.alphSize != m.alphSize:
             raise NameError("Models must have the same alphabet to be merged")
+        if self.sketchOrder != m.sketchOrder:
+            raise NameError("Models must count the same orders in a sketch to be merged")
+        if self.sketch is not None:
+            self.sketch.merge(m.sketch)
         self.cnt += m.cnt
         for i in range(self.modelOrder + 1):
             self.orders[i].merge(m.orders[i])
@@ -183,6 +344,10 @@ class Model(object):
     def negate(self, m):
         if self.modelOrder != m.modelOrder or self.alphSize != m.alphSize or self.cnt < m.cnt:
             raise NameError("Model does not contain the Model to be negated")
+        if self.sketchOrder != m.sketchOrder:
+            raise NameError("Model does not contain the Model to be negated")
+        if self.sketch is not None:
+            self.sketch.negate(m.sketch)
         self.cnt -= m.cnt
         for i in range(self.modelOrder + 1):
             self.orders[i].negate(m.orders[i])
@@ -226,6 +391,109 @@ class Order(object):
         for c in empty:
             del self.contexts[c]
 
+    # estimated memory footprint of the dictionaries of this order in bytes
+    def memorySize(self):
+        size = sys.getsizeof(self.contexts)
+        for cont, context in self.contexts.items():
+            size += sys.getsizeof(cont) + sys.getsizeof(context) + \
+                    sys.getsizeof(context.chars)
+            for c in context.chars:
+                size += sys.getsizeof(c)
+        return size
+
+
+class SketchOrder(object):
+    # n - which order
+    # cnt - character count of this order
+    # sketch - CountMinSketch holding the counts, shared with other orders
+    def __init__(self, n, sketch):
+        self.n = n
+        self.cnt = 0
+        self.sketch = sketch
+
+    # count character c in context cont
+    def add(self, c, cont):
+        self.sketch.add("c" + cont)
+        self.sketch.add("s" + cont + c)
+
+    # estimated number of characters read in context cont
+    def contextCount(self, cont):
+        return self.sketch.count("c" + cont)
+
+    # estimated number of times character c was read in context cont
+    def charCount(self, c, cont):
+        return self.sketch.count("s" + cont + c)
+
+    # the counts are merged with the sketch by the Model
+    def merge(self, o):
+        self.cnt += o.cnt
+
+    def negate(self, o):
+        if self.cnt < o.cnt:
+            raise NameError(
+                "Model1 does not contain the Model2 to be negated, Model1 might be corrupted!")
+        self.cnt -= o.cnt
+
+    # the sketch is accounted for by the Model
+    def memorySize(self):
+        return sys.getsizeof(self)
+
+
+class CountMinSketch(object):
+    # Count-min sketch with conservative update. Counts are overestimated by
+    # at most epsilon * (total count) with probability 1 - delta.
+    # width - number of counters per row, ceil(e / epsilon)
+    # depth - number of rows, ceil(ln(1 / delta)), at most 16
+    # table - depth * width 32-bit counters
+    def __init__(self, epsilon=1e-5, delta=0.01):
+        if not 0 < epsilon < 1 or not 0 < delta < 1:
+            raise ValueError("epsilon and delta must be in (0, 1)")
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        if self.depth > 16:
+            raise ValueError("delta is too small, at most 16 rows are supported")
+        self.table = array('I', bytes(4 * self.width * self.depth))
+
+    # positions of key in the table, one per row
+    def _cells(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'),
+                                 digest_size=4 * self.depth).digest()
+        hashes = struct.unpack('<%dI' % self.depth, digest)
+        return [row * self.width + hashes[row] % self.width
+                for row in range(self.depth)]
+
+    def add(self, key):
+        cells = self._cells(key)
+        m = min(self.table[i] for i in cells)
+        for i in cells:
+            if self.table[i] == m:
+                self.table[i] = m + 1
+
+    def count(self, key):
+        return min(self.table[i] for i in self._cells(key))
+
+    def _checkShape(self, s):
+        if self.width != s.width or self.depth != s.depth:
+            raise NameError("Sketches must have the same width and depth")
+
+    def merge(self, s):
+        self._checkShape(s)
+        for i in range(len(self.table)):
+            self.table[i] += s.table[i]
+
+    def negate(self, s):
+        self._checkShape(s)
+        for i in range(len(self.table)):
+            if self.table[i] < s.table[i]:
+                raise NameError(
+                    "Model1 does not contain the Model2 to be negated, Model1 might be corrupted!")
+            self.table[i] -= s.table[i]
+
+    def memorySize(self):
+        return self.table.buffer_info()[1] * self.table.itemsize
+
 
 class Context(object):
     # chars - Dictionary containing character counts of the given context
@@ -283,64 +551,405 @@ def h(m, s):
         else:
             context = s[i - m.modelOrder:i]
         h -= log(m.p(s[i], context), 2)
+        if m.backoffs is not None:
+            depth = len(context) - m.answered
+            m.backoffs[depth] = m.backoffs.get(depth, 0) + 1
     return h / n
 
 
+# splits an iterable of strings into consecutive segments of segment_size
+# characters (the last one may be shorter)
+def segments(chunks, segment_size):
+    if segment_size < 1:
+        raise ValueError("segment_size must be positive")
+    # buf holds the tail of the previous chunks, shorter than segment_size;
+    # each chunk is walked with an offset instead of being copied
+    buf = ""
+    for chunk in chunks:
+        pos = 0
+        if buf:
+            pos = segment_size - len(buf)
+            if len(chunk) < pos:
+                buf += chunk
+                continue
+            yield buf + chunk[:pos]
+        while len(chunk) - pos >= segment_size:
+            yield chunk[pos:pos + segment_size]
+            pos += segment_size
+        buf = chunk[pos:]
+    if buf:
+        yield buf
+
+
+# calculates the cross-entropy of the text given as an iterable of strings
+# using model 'm', segment by segment. The PPM context is carried over
+# segment boundaries, so the overall value equals h(m, ''.join(chunks)).
+# Returns the overall cross-entropy and the list of per-segment
+# cross-entropies (the entropy profile of the text)
+def h_segments(m, chunks, segment_size=10000):
+    history = ""
+    total = 0
+    n = 0
+    profile = []
+    for segment in segments(chunks, segment_size):
+        s = history + segment
+        hs = 0
+        for i in range(len(history), len(s)):
+            context = s[max(0, i - m.modelOrder):i]
+            hs -= log(m.p(s[i], context), 2)
+            if m.backoffs is not None:
+                depth = len(context) - m.answered
+                m.backoffs[depth] = m.backoffs.get(depth, 0) + 1
+        profile.append(hs / len(segment))
+        total += hs
+        n += len(segment)
+        history = s[max(0, len(s) - m.modelOrder):]
+    return total / n, profile
+
+
 # Calculates the cross-entropy of text2 using the model of text1 and vice-versa
 # Returns the mean and the absolute difference of the two cross-entropies
-def distance(text1, text2, ppm_order=5):
-    mod1 = Model(ppm_order, 256)
-    mod1.read(text1)
+# sketch - keyword arguments for Model (sketchOrder, epsilon, delta) to count
+# the high orders in a CountMinSketch, or None
+# sparse - count only the contexts the other text looks up (same result).
+# A memory option for pairs where one text is much longer than the other:
+# it does not make distance() faster and saves little memory for texts of
+# similar length, as the keep set holds the contexts of the other text
+# memory - list to append Model.memorySize() of both models to, or None
+def distance(text1, text2, ppm_order=5, sketch=None, sparse=False,
+             memory=None):
+    sketch = sketch or {}
+    mod1 = Model(ppm_order, 256, **sketch)
+    mod1.read(text1, mod1.queryContexts(text2) if sparse else None)
     d1 = h(mod1, text2)
-    mod2 = Model(ppm_order, 256)
-    mod2.read(text2)
+    if memory is not None:
+        memory.append(mod1.memorySize())
+    # only one model is alive at a time
+    del mod1
+    mod2 = Model(ppm_order, 256, **sketch)
+    mod2.read(text2, mod2.queryContexts(text1) if sparse else None)
     d2 = h(mod2, text1)
+    if memory is not None:
+        memory.append(mod2.memorySize())
     return [round((d1 + d2) / 2.0, 4), round(abs(d1 - d2), 4)]
 
 
+# Distance engines selectable with --engine. 'ppm' is the PPM model above,
+# the others use the stdlib C compressors and are much faster. The '_ncd'
+# variants replace the mean cross-compression by the normalized compression
+# distance of the pair
+ENGINES = ['ppm', 'zlib', 'bz2', 'lzma', 'zlib_ncd', 'bz2_ncd', 'lzma_ncd']
+
+
+# size in bytes of data compressed with the given stdlib compressor
+def compressed_size(data, engine):
+    if engine == 'zlib':
+        return len(zlib.compress(data, 9))
+    if engine == 'bz2':
+        return len(bz2.compress(data, 9))
+    if engine == 'lzma':
+        # preset 9 allocates a 64 MiB dictionary on every call, which costs
+        # more than compressing a text pair. A dictionary sized to the input
+        # gives the same output
+        filters = [{'id': lzma.FILTER_LZMA2, 'preset': 9,
+                    'dict_size': max(len(data), 4096)}]
+        return len(lzma.compress(data, filters=filters))
+    raise NameError("Unknown compression engine: " + str(engine))
+
+
+# calculates the cross-compression of text2 given text1 in bits per character,
+# the compressor counterpart of h(model of text1, text2). zlib uses text1 as
+# preset dictionary (only its last 32 KiB fit in the window), bz2 and lzma
+# have no preset dictionaries, so C(text1 + text2) - C(text1) is used
+def cross_compression(text1, text2, engine):
+    b1 = text1.encode('utf-8')
+    b2 = text2.encode('utf-8')
+    if engine == 'zlib':
+        comp = zlib.compressobj(9, zdict=b1[-32768:])
+        size = len(comp.compress(b2) + comp.flush())
+    else:
+        size = compressed_size(b1 + b2, engine) - compressed_size(b1, engine)
+    return 8.0 * size / len(text2)
+
+
+# Normalized compression distance from the compressed sizes of text1, text2
+# and text1 + text2
+def ncd_sizes(c1, c2, c12):
+    return (c12 - min(c1, c2)) / float(max(c1, c2))
+
+
+# Normalized compression distance of text1 and text2
+def ncd(text1, text2, engine='zlib'):
+    b1 = text1.encode('utf-8')
+    b2 = text2.encode('utf-8')
+    return ncd_sizes(compressed_size(b1, engine), compressed_size(b2, engine),
+                     compressed_size(b1 + b2, engine))
+
+
+# Same as distance() but based on the cross-compression of the texts
+# For the '_ncd' engines the first feature is the ncd and both features come
+# from the four sizes C(text1), C(text2), C(text1 + text2), C(text2 + text1),
+# so the cross-compressions are C(text1 + text2) - C(text1) for every
+# compressor (no zlib preset dictionary)
+def compression_distance(text1, text2, engine='zlib'):
+    if not engine.endswith('_ncd'):
+        d1 = cross_compression(text1, text2, engine)
+        d2 = cross_compression(text2, text1, engine)
+        return [round((d1 + d2) / 2.0, 4), round(abs(d1 - d2), 4)]
+    compressor = engine[:-len('_ncd')]
+    b1 = text1.encode('utf-8')
+    b2 = text2.encode('utf-8')
+    c1, c2, c12, c21 = [compressed_size(b, compressor)
+                        for b in (b1, b2, b1 + b2, b2 + b1)]
+    d1 = 8.0 * (c12 - c1) / len(text2)
+    d2 = 8.0 * (c21 - c2) / len(text1)
+    return [round(ncd_sizes(c1, c2, c12), 4), round(abs(d1 - d2), 4)]
+
+
+# Returns the two-feature vector of a text pair for the given engine
+def features(text1, text2, ppm_order=5, engine='ppm', sketch=None,
+             sparse=False, memory=None):
+    if engine == 'ppm':
+        return distance(text1, text2, ppm_order, sketch, sparse, memory)
+    return compression_distance(text1, text2, engine)
+
+
+class CountTables(object):
+    # PPM count tables of a batch of texts, built with NumPy instead of
+    # character by character through Model.update. Symbols are coded over
+    # the joint alphabet of the batch (A symbols). Contexts are numbered per
+    # order: a context of order k is the pair (context of order k - 1, symbol
+    # k positions back), renumbered with np.unique, so every id stays below
+    # the number of positions whatever the alphabet and the order.
+    # ppmOrder - order of the models
+    # chars - symbol of every code
+    # codes - symbol codes of all texts, concatenated
+    # starts, lengths - position and length of every text in codes
+    # ctxIds[k] - id of the order k context of every position in codes
+    # ctxKeys[k] - (id of order k - 1 * A + symbol) of every order k id
+    # For every order k:
+    # keys[k], counts[k] - sorted (context * A + symbol) codes and their
+    #   counts, per text; offsets[k][i]:offsets[k][i + 1] is the slice of
+    #   text i
+    # contexts[k], totals[k], ctxOffsets[k] - the same for the contexts
+    def __init__(self, texts, ppm_order=5):
+        import numpy as np
+
+        self.ppmOrder = ppm_order
+        self.lengths = np.array([len(t) for t in texts], dtype=np.int64)
+        self.starts = np.cumsum(self.lengths) - self.lengths
+        # UTF-32 code points keep NUL and every other character intact
+        cps = np.frombuffer(''.join(texts).encode('utf-32-le'), dtype=np.uint32)
+        vocab, codes = np.unique(cps, return_inverse=True)
+        self.codes = codes.astype(np.int64).ravel()
+        self.chars = [chr(c) for c in vocab.tolist()]
+        self.A = A = max(len(vocab), 1)
+        self._contextIds()
+
+        n_texts = len(texts)
+        tids = np.repeat(np.arange(n_texts), self.lengths)
+        local = np.arange(len(self.codes)) - self.starts[tids]
+        self.keys, self.counts, self.offsets = [], [], []
+        self.contexts, self.totals, self.ctxOffsets = [], [], []
+        for k, ctx in enumerate(self.ctxIds):
+            valid = local >= k
+            t = tids[valid]
+            key = ctx[valid] * A + self.codes[valid]
+            idx = np.lexsort((key, t))
+            t, key = t[idx], key[idx]
+            new = np.ones(len(key), dtype=bool)
+            new[1:] = (t[1:] != t[:-1]) | (key[1:] != key[:-1])
+            first = np.flatnonzero(new)
+            counts = np.diff(np.append(first, len(key)))
+            t, key = t[first], key[first]
+
+            # entries of the same text and context are adjacent
+            cont = key // A
+            group = np.ones(len(key), dtype=bool)
+            group[1:] = (t[1:] != t[:-1]) | (cont[1:] != cont[:-1])
+            gstarts = np.flatnonzero(group)
+
+            self.keys.append(key)
+            self.counts.append(counts)
+            self.offsets.append(np.searchsorted(t, np.arange(n_texts + 1)))
+            self.contexts.append(cont[gstarts])
+            self.totals.append(np.add.reduceat(counts, gstarts)
+                               if len(gstarts) else counts[:0])
+            self.ctxOffsets.append(np.searchsorted(t[gstarts],
+                                                   np.arange(n_texts + 1)))
+
+    # numbers the contexts of every position for orders 0..ppmOrder;
+    # positions closer than k to the start of their text are not valid
+    # for order k and must be masked by the caller
+    def _contextIds(self):
+        import numpy as np
+
+        n = len(self.codes)
+        ids = np.zeros(n, dtype=np.int64)
+        self.ctxIds, self.ctxKeys = [ids], [ids[:0]]
+        for k in range(1, self.ppmOrder + 1):
+            prev = np.zeros(n, dtype=np.int64)
+            prev[k:] = self.codes[:max(n - k, 0)]
+            keys, ids = np.unique(ids * self.A + prev, return_inverse=True)
+            ids = ids.astype(np.int64).ravel()
+            self.ctxIds.append(ids)
+            self.ctxKeys.append(keys)
+
+    # returns the string of context id cont of order k
+    def _contextString(self, k, cont):
+        chars = []
+        for j in range(k, 0, -1):
+            cont, c = divmod(int(self.ctxKeys[j][cont]), self.A)
+            chars.append(self.chars[c])
+        return ''.join(chars)
+
+    # calculates the cross-entropy of text q using the model of text m,
+    # equal to h(Model of text m, text q) but vectorized over the positions:
+    # every position is answered by the highest order whose context has
+    # seen its symbol, the others get 1 / alphSize
+    def crossEntropy(self, m, q, alphSize=256):
+        import numpy as np
+
+        n = int(self.lengths[q])
+        if n == 0:
+            raise ZeroDivisionError("division by zero")
+        start = self.starts[q]
+        s = self.codes[start:start + n]
+        prob = np.full(n, 1.0 / alphSize)
+        todo = np.ones(n, dtype=bool)
+        ctxs = [ids[start:start + n] for ids in self.ctxIds]
+        for k in range(self.ppmOrder, -1, -1):
+            lo, hi = self.offsets[k][m], self.offsets[k][m + 1]
+            pos = np.flatnonzero(todo[k:]) + k
+            if lo == hi or len(pos) == 0:
+                continue
+            keys = self.keys[k][lo:hi]
+            ctx = ctxs[k][pos]
+            key = ctx * self.A + s[pos]
+            j = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            hit = keys[j] == key
+            clo, chi = self.ctxOffsets[k][m], self.ctxOffsets[k][m + 1]
+            c = np.searchsorted(self.contexts[k][clo:chi], ctx[hit])
+            prob[pos[hit]] = self.counts[k][lo:hi][j[hit]] / \
+                self.totals[k][clo:chi][c]
+            todo[pos[hit]] = False
+        return float(-np.log2(prob).sum() / n)
+
+    # returns the Model of text i, equal to Model(ppmOrder, alphSize) after
+    # read(text). Creating the Python dictionaries is much slower than
+    # building the tables, use crossEntropy where possible
+    def model(self, i, alphSize=256):
+        A = self.A
+        m = Model(self.ppmOrder, alphSize)
+        n = int(self.lengths[i])
+        m.cnt = n
+        for k in range(self.ppmOrder + 1):
+            order = m.orders[k]
+            order.cnt = max(n - k, 0)
+            lo, hi = self.offsets[k][i], self.offsets[k][i + 1]
+            keys = self.keys[k][lo:hi].tolist()
+            counts = self.counts[k][lo:hi].tolist()
+            for key, cnt in zip(keys, counts):
+                cont, c = divmod(key, A)
+                cont = self._contextString(k, cont)
+                context = order.contexts.get(cont)
+                if context is None:
+                    context = order.contexts[cont] = Context()
+                context.chars[self.chars[c]] = cnt
+                context.cnt += cnt
+        return m
+
+
+# Builds the PPM models of many texts at once, see CountTables
+# Returns one Model per text, equal to Model(ppm_order, alphSize) after
+# read(text)
+def build_models(texts, ppm_order=5, alphSize=256):
+    tables = CountTables(texts, ppm_order)
+    return [tables.model(i, alphSize) for i in range(len(texts))]
+
+
+# Same as distance() for many pairs. All count tables are built in one
+# CountTables and the cross-entropies are calculated from the tables
+def batch_distance(pairs, ppm_order=5):
+    tables = CountTables([text for pair in pairs for text in pair], ppm_order)
+    result = []
+    for i in range(len(pairs)):
+        d1 = tables.crossEntropy(2 * i, 2 * i + 1)
+        d2 = tables.crossEntropy(2 * i + 1, 2 * i)
+        result.append([round((d1 + d2) / 2.0, 4), round(abs(d1 - d2), 4)])
+    return result
+
+
 def now(): return time.strftime("%Y-%m-%d_%H-%M-%S")
 
 
 # Prepares training data
 # For each verification case it calculates the mean and absolute differences of cross-entropies
 def prep_data(train_file, truth_file, output_folder='prepared', out_name='',
-              ppm_order=5):
+              ppm_order=5, engine='ppm', sketch=None, sparse=False,
+              batch_size=0):
+    from statistics import mean
+    from tqdm import tqdm
+
     print('Loading data...')
-    with open(truth_file, 'r') as tfp:
-        labels = []
-        for line in tfp:
-            labels.append(json.loads(line))
+    labels = []
+    if truth_file:
+        with open(truth_file, 'r') as tfp:
+            for line in tfp:
+                labels.append(json.loads(line))
     print('Calculating cross-entropies...')
     with open(train_file, 'r') as fp:
         data = []
         tr_labels = []
+        ids = []
         tr_data = {}
-        for i, line in tqdm(enumerate(fp), total=len(labels)):
+        # pairs waiting for batch_distance if batch_size > 0
+        batch = []
+        # memory of every PPM model, reported for sketched models
+        memory = [] if sketch else None
+        for i, line in tqdm(enumerate(fp), total=len(labels) or None):
             X = json.loads(line)
-            # Next line is ok performance-wise
-            true_label = [x for x in labels if x["id"] == X["id"]]
-            if not true_label:
-                continue
-            d = distance(X['pair'][0], X['pair'][1], ppm_order)
-            data.append(d)
-            if true_label[0]["same"]:
-                tl = 1
+            if truth_file:
+                # Next line is ok performance-wise
+                true_label = [x for x in labels if x["id"] == X["id"]]
+                if not true_label:
+                    continue
+                tr_labels.append(1 if true_label[0]["same"] else 0)
+            ids.append(X['id'])
+            if batch_size > 0:
+                batch.append(X['pair'])
+                if len(batch) == batch_size:
+                    data.extend(batch_distance(batch, ppm_order))
+                    batch = []
             else:
-                tl = 0
-            tr_labels.append(tl)
+                d = features(X['pair'][0], X['pair'][1], ppm_order, engine,
+                             sketch, sparse, memory)
+                data.append(d)
             # print(i,X['id'],D[0],true_label["same"])
+        if batch:
+            data.extend(batch_distance(batch, ppm_order))
 
+        if memory:
+            print('Model memory: mean %d, max %d bytes over %d models' %
+                  (mean(memory), max(memory), len(memory)))
         print('Writing results...')
-        # Saves training data
+        # Saves training data, without labels if no truth file is given,
+        # and the settings the features were calculated with
         tr_data["data"] = data
-        tr_data["labels"] = tr_labels
+        if truth_file:
+            tr_data["labels"] = tr_labels
+        tr_data["ids"] = ids
+        tr_data["ppm_order"] = ppm_order
+        tr_data["engine"] = engine
+        tr_data["sketch"] = sketch
         if out_name == '':
             out_name = f'prep_{now()}.json'
         with open(os.path.join('data', output_folder, out_name), 'w') as outf:
             json.dump(tr_data, outf)
 
 
-def prep_data_dir(train_folder, truth_file, ppm_order=5):
+def prep_data_dir(train_folder, truth_file, ppm_order=5, engine='ppm',
+                  sketch=None, sparse=False, batch_size=0):
     directory = [d for d in os.scandir(train_folder)]
     print(f'Found {len(directory)} PAN20 data folders.')
     output_folder = f'prepared_{now()}/'
@@ -360,11 +969,14 @@ def prep_data_dir(train_folder, truth_file, ppm_order=5):
 
         prep_data(input_files[0], truth_file, output_folder,
                   f'{os.path.basename(input_files[0])}',
-                  ppm_order)
+                  ppm_order, engine, sketch, sparse, batch_size)
 
 
 # Trains the logistic regression model
 def train_model(train_data_file, out_name=''):
+    from sklearn.linear_model import LogisticRegression
+    from joblib import dump
+
     print('Loading data...')
     with open(train_data_file) as fp:
         D1 = json.load(fp)
@@ -376,25 +988,75 @@ def train_model(train_data_file, out_name=''):
     print('Writing results...')
     if out_name == '':
         out_name = f'model_{now()}.json'
-    dump(logreg, os.path.join('data', 'model', out_name))
+    # The feature settings are stored with the model, so apply can
+    # calculate or check the features the same way
+    dump({'model': logreg,
+          'ppm_order': D1.get('ppm_order', 5),
+          'engine': D1.get('engine', 'ppm'),
+          'sketch': D1.get('sketch')},
+         os.path.join('data', 'model', out_name))
+
+
+# Loads a model file written by train_model
+# Returns a dict with the classifier ('model') and the feature settings
+# ('ppm_order', 'engine', 'sketch'). Model files that only contain the
+# classifier were trained on PPM order 5 features
+def load_model(model_file):
+    from joblib import load
+
+    model = load(model_file)
+    if isinstance(model, dict):
+        return model
+    return {'model': model, 'ppm_order': 5, 'engine': 'ppm', 'sketch': None}
+
+
+# Raises a RuntimeError if the prepared features D1 were not calculated
+# with the settings of the model
+def check_features(D1, model):
+    for key, default in (('ppm_order', 5), ('engine', 'ppm'), ('sketch', None)):
+        if D1.get(key, default) != model[key]:
+            raise RuntimeError(f'Features were prepared with {key}='
+                               f'{D1.get(key, default)}, but the model was '
+                               f'trained with {key}={model[key]}')
+    if 'ids' not in D1:
+        raise RuntimeError('Prepared features do not contain the ids of the cases')
 
 
 # Applies the model to evaluation data
 # Produces an output file (answers.jsonl) with predictions
-def apply_model(eval_data_file, output_folder, model_file, radius):
+# If features_file is given, the features prepared from the evaluation data
+# (prep without truth file) are used instead of calculating them again
+def apply_model(eval_data_file, output_folder, model_file, radius,
+                engine=None, features_file=None):
     start_time = time.time()
-    model = load(model_file)
+    meta = load_model(model_file)
+    model = meta['model']
+    if engine is not None and engine != meta['engine']:
+        raise RuntimeError(f"The model was trained with engine={meta['engine']}")
     answers = []
-    with open(eval_data_file, 'r') as fp:
-        for i, line in enumerate(fp):
-            X = json.loads(line)
-            D = distance(X['pair'][0], X['pair'][1], ppm_order=5)
-            pred = model.predict_proba([D])
+    if features_file:
+        with open(features_file, 'r') as fp:
+            D1 = json.load(fp)
+        check_features(D1, meta)
+        preds = model.predict_proba(D1['data'])[:, 1] if D1['data'] else []
+        for i, (case_id, pred) in enumerate(zip(D1['ids'], preds)):
             # All values around 0.5 are transformed to 0.5
-            if 0.5 - radius <= pred[0, 1] <= 0.5 + radius:
-                pred[0, 1] = 0.5
-            print(i + 1, X['id'], round(pred[0, 1], 3))
-            answers.append({'id': X['id'], 'value': round(pred[0, 1], 3)})
+            if 0.5 - radius <= pred <= 0.5 + radius:
+                pred = 0.5
+            print(i + 1, case_id, round(pred, 3))
+            answers.append({'id': case_id, 'value': round(pred, 3)})
+    else:
+        with open(eval_data_file, 'r') as fp:
+            for i, line in enumerate(fp):
+                X = json.loads(line)
+                D = features(X['pair'][0], X['pair'][1], meta['ppm_order'],
+                             meta['engine'], meta['sketch'])
+                pred = model.predict_proba([D])
+                # All values around 0.5 are transformed to 0.5
+                if 0.5 - radius <= pred[0, 1] <= 0.5 + radius:
+                    pred[0, 1] = 0.5
+                print(i + 1, X['id'], round(pred[0, 1], 3))
+                answers.append({'id': X['id'], 'value': round(pred[0, 1], 3)})
     with open(output_folder + os.sep + 'answers.jsonl', 'w') as outfile:
         for ans in answers:
             json.dump(ans, outfile)
@@ -402,7 +1064,27 @@ def apply_model(eval_data_file, output_folder, model_file, radius):
     print('elapsed time:', time.time() - start_time)
 
 
-def crossval(input, k, radius, output_folder='eval', output_name=''):
+# Returns the StratifiedKFold splits of labels y for each of the 3 repetitions
+def fold_splits(y, k):
+    import numpy as np
+    from sklearn.model_selection import StratifiedKFold
+
+    y = np.array(y, dtype=np.float64)
+    return [list(StratifiedKFold(n_splits=k, shuffle=True,
+                                 random_state=repetition).split(y, y))
+            for repetition in range(3)]
+
+
+# Cross-validates the logistic regression on prepared data
+# splits can be given to use the same folds for several prepared files
+def crossval(input, k, radius, output_folder='eval', output_name='',
+             splits=None):
+    from statistics import mean
+    import numpy as np
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import StratifiedKFold
+    from pan20_verif_evaluator import evaluate_all
+
     print('Loading data...')
     with open(input, 'r') as f:
         D1 = json.load(f)
@@ -417,7 +1099,11 @@ def crossval(input, k, radius, output_folder='eval', output_name=''):
     for repetition in range(3):
         print(f'Cross-validation repetition {repetition}')
 
-        kf = StratifiedKFold(n_splits=k, shuffle=True, random_state=repetition)
+        if splits is None:
+            kf = StratifiedKFold(n_splits=k, shuffle=True, random_state=repetition)
+            folds = kf.split(X, y)
+        else:
+            folds = splits[repetition]
 
         results[repetition] = dict()
         results[repetition]['accuracy'] = []
@@ -428,7 +1114,7 @@ def crossval(input, k, radius, output_folder='eval', output_name=''):
         results[repetition]['f_05_u'] = []
 
         # Cross validating
-        for train, test in kf.split(X, y):
+        for train, test in folds:
             X_train, X_test, y_train, y_test = X[train], X[test], y[train], y[test]
 
             # Fitting regression
@@ -475,19 +1161,208 @@ def crossval(input, k, radius, output_folder='eval', output_name=''):
         output_name = f'eval_{now()}.json'
     with open(os.path.join('data', output_folder, output_name), 'w') as f:
         json.dump(dto, f, indent=4)
-
-
-def crossval_dir(eval_data_folder, k, radius):
-    directory = [d for d in os.scandir(eval_data_folder)]
+    return results
+
+
+METRICS = ['c_at_1', 'f_05_u', 'f1', 'precision', 'recall', 'accuracy']
+
+
+# Same as crossval() but returns (results, None), or (None, error message)
+# if the cross-validation fails, so one variant cannot abort crossval_dir
+def try_crossval(input, k, radius, output_folder='eval', output_name='',
+                 splits=None):
+    try:
+        return crossval(input, k, radius, output_folder, output_name,
+                        splits), None
+    except Exception as e:
+        print(f'Cross-validation of {input} failed: {e!r}')
+        return None, f'{type(e).__name__}: {e}'
+
+
+# Cross-validates all prepared files of a folder in parallel on the same
+# folds and writes a leaderboard with mean and std of each metric per file
+def crossval_dir(eval_data_folder, k, radius, jobs=-1):
+    import csv
+    import numpy as np
+    from joblib import Parallel, delayed
+
+    # Prepared files are named .json by prep and .jsonl (after their input)
+    # by prep on a folder; other entries and unlabeled files are skipped
+    directory = []
+    labels = None
+    for dir_entry in sorted(os.scandir(eval_data_folder), key=lambda d: d.name):
+        if not dir_entry.is_file() or \
+                not dir_entry.name.endswith(('.json', '.jsonl')):
+            print(f'Skipping {dir_entry.name}: not a prepared data file.')
+            continue
+        try:
+            with open(dir_entry.path, 'r') as f:
+                y = json.load(f)['labels']
+        except (ValueError, KeyError, TypeError):
+            print(f'Skipping {dir_entry.name}: no labeled prepared data.')
+            continue
+        # All variants must describe the same cases, so the folds are paired
+        if labels is None:
+            labels = y
+        elif y != labels:
+            raise RuntimeError(f'Labels of {dir_entry.name} differ from '
+                               f'{directory[0].name}, folds cannot be shared')
+        directory.append(dir_entry)
+    if not directory:
+        raise RuntimeError(f'No labeled prepared data files found in {eval_data_folder}')
     print(f'Found {len(directory)} prepared data files.')
     output_folder = f'evaluated_{now()}/'
     os.makedirs(os.path.dirname(os.path.join('data', output_folder)),
                 exist_ok=True)
-    for dir_entry in directory:
-        # if dir_entry.name in ['cv_gb.jsonl', 'cv_4grams_gb.jsonl', 'dolgo_4grams_gb.jsonl', 'punct_4grams_gb.jsonl', 'dolgo_gb.jsonl', 'asjp_4grams_gb.jsonl', 'refsoundex_gb.jsonl', 'soundex_gb.jsonl']:
-        #     continue
-        print(f'Cross-validating {dir_entry.name}...')
-        crossval(dir_entry.path, k, radius, output_folder, f'{dir_entry.name}')
+    splits = fold_splits(labels, k)
+
+    print(f'Cross-validating {len(directory)} files...')
+    all_results = Parallel(n_jobs=jobs)(
+        delayed(try_crossval)(dir_entry.path, k, radius, output_folder,
+                              f'{dir_entry.name}', splits)
+        for dir_entry in directory)
+
+    # Failed variants get empty metrics and their error, after the others
+    leaderboard = []
+    for dir_entry, (results, error) in zip(directory, all_results):
+        row = {'variant': dir_entry.name}
+        for metric in METRICS:
+            if results is None:
+                row[f'{metric}_mean'] = row[f'{metric}_std'] = None
+                continue
+            values = [v for repetition in range(3)
+                      for v in results[repetition][metric]]
+            row[f'{metric}_mean'] = float(np.mean(values))
+            row[f'{metric}_std'] = float(np.std(values))
+        row['error'] = error or ''
+        leaderboard.append(row)
+    leaderboard.sort(key=lambda row: (row['error'] == '',
+                                      row['c_at_1_mean'] or 0.0),
+                     reverse=True)
+
+    with open(os.path.join('data', output_folder, 'leaderboard.json'), 'w') as f:
+        json.dump(leaderboard, f, indent=4)
+    with open(os.path.join('data', output_folder, 'leaderboard.csv'), 'w',
+              newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(leaderboard[0]))
+        writer.writeheader()
+        writer.writerows(leaderboard)
+    failed = [row['variant'] for row in leaderboard if row['error']]
+    if failed:
+        print(f'Cross-validation failed for {len(failed)} of '
+              f'{len(leaderboard)} files: {", ".join(failed)}')
+
+
+# Large Mersenne prime for the MinHash permutations (a * x + b) mod p
+MINHASH_PRIME = (1 << 31) - 1
+
+
+# Returns the set of 32-bit hashes of the character n-grams of text
+def ngram_hashes(text, ngram=4):
+    return {zlib.crc32(text[i:i + ngram].encode('utf-8'))
+            for i in range(len(text) - ngram + 1)}
+
+
+# Draws num_perm random permutations for MinHash
+def minhash_params(num_perm=128, seed=1):
+    import numpy as np
+    rs = np.random.RandomState(seed)
+    a = rs.randint(1, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    b = rs.randint(0, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    return a, b
+
+
+# Calculates the MinHash signature of the character n-grams of text.
+# Texts shorter than ngram get a signature of MINHASH_PRIME everywhere
+def minhash(text, a, b, ngram=4):
+    import numpy as np
+    sig = np.full(len(a), MINHASH_PRIME, dtype=np.uint64)
+    hashes = np.fromiter(ngram_hashes(text, ngram), dtype=np.uint64)
+    if len(hashes) == 0:
+        return sig
+    p = np.uint64(MINHASH_PRIME)
+    hashes %= p
+    for j in range(len(a)):
+        sig[j] = ((a[j] * hashes + b[j]) % p).min()
+    return sig
+
+
+# Builds the sketch index of a library of texts
+# The library is a JSONL file with one {"id": ..., "text": ...} per line,
+# the index stores the signatures and the path to the library
+def build_index(library_file, out_name='', ngram=4, num_perm=128, seed=1):
+    from tqdm import tqdm
+
+    a, b = minhash_params(num_perm, seed)
+    ids = []
+    offsets = []
+    signatures = []
+    print('Sketching library...')
+    # byte offset of every document, so search only reads its candidates
+    offset = 0
+    with open(library_file, 'rb') as fp:
+        for line in tqdm(fp):
+            X = json.loads(line)
+            ids.append(X['id'])
+            offsets.append(offset)
+            offset += len(line)
+            signatures.append(minhash(X['text'], a, b, ngram).tolist())
+    index = {'library': os.path.abspath(library_file), 'ngram': ngram,
+             'num_perm': num_perm, 'seed': seed, 'ids': ids,
+             'offsets': offsets, 'signatures': signatures}
+    print('Writing results...')
+    if out_name == '':
+        out_name = f'index_{now()}.json'
+    with open(os.path.join('data', 'index', out_name), 'w') as outf:
+        json.dump(index, outf)
+
+
+# Yields (document, position in the index) for the given index positions of
+# the open library file. Documents are read at their byte offsets; indexes
+# built without offsets are scanned line by line
+def library_documents(fp, index, positions):
+    if 'offsets' in index:
+        for j in positions:
+            fp.seek(index['offsets'][j])
+            yield json.loads(fp.readline()), j
+        return
+    wanted = set(int(j) for j in positions)
+    for j, line in enumerate(fp):
+        if j in wanted:
+            yield json.loads(line), j
+
+
+# Searches the library of an index for the texts most likely written by the
+# author of the query text. The sketches prune the library to the top_m
+# candidates by estimated n-gram Jaccard similarity, only those are scored
+# with the distance engine and the trained model.
+# Returns the top_k candidates by model score
+def search(query, index_file, model_file, top_m=100, top_k=10):
+    import numpy as np
+
+    with open(index_file, 'r') as fp:
+        index = json.load(fp)
+    meta = load_model(model_file)
+    model = meta['model']
+    a, b = minhash_params(index['num_perm'], index['seed'])
+    q = minhash(query, a, b, index['ngram'])
+    signatures = np.array(index['signatures'], dtype=np.uint64)
+    jaccard = (signatures == q).mean(axis=1)
+    order = np.argsort(-jaccard, kind='stable')[:top_m]
+
+    results = []
+    with open(index['library'], 'rb') as fp:
+        for X, j in library_documents(fp, index, order):
+            D = features(query, X['text'], meta['ppm_order'], meta['engine'],
+                         meta['sketch'])
+            pred = model.predict_proba([D])
+            results.append({'id': X['id'], 'jaccard': float(jaccard[j]),
+                            'distance': D, 'value': round(pred[0, 1], 3)})
+    results.sort(key=lambda r: r['value'], reverse=True)
+    return {'library_size': len(index['ids']),
+            'candidates': len(order),
+            'pruned': len(index['ids']) - len(order),
+            'results': results[:top_k]}
 
 
 def main():
@@ -503,11 +1378,25 @@ def main():
     prep_parser.add_argument('-i', '--train', type=str,
                              help='PAN20 formatted training data')
     prep_parser.add_argument('-w', '--truth', type=str,
-                             help='PAN20 formatted truth data')
+                             help='PAN20 formatted truth data (omit for unlabeled test data)')
     prep_parser.add_argument('-o', '--output', type=str, default='',
                              help='Name of output file')
     prep_parser.add_argument('-p', '--ppm_order', type=int, default=5,
                              help='Prediction by Partial Matching order')
+    prep_parser.add_argument('-e', '--engine', type=str, default='ppm',
+                             choices=ENGINES,
+                             help='Distance engine: PPM model or a stdlib compressor')
+    prep_parser.add_argument('--sketch_order', type=int, default=None,
+                             help='Count PPM orders from this one up in a count-min sketch')
+    prep_parser.add_argument('--sketch_epsilon', type=float, default=1e-5,
+                             help='Count-min sketch error relative to the total count')
+    prep_parser.add_argument('--sketch_delta', type=float, default=0.01,
+                             help='Count-min sketch probability of exceeding the error')
+    prep_parser.add_argument('--sparse', action='store_true',
+                             help='Count only the contexts the other text of a pair looks up; '
+                                  'lowers memory for pairs of very different lengths, not faster')
+    prep_parser.add_argument('-b', '--batch_size', type=int, default=0,
+                             help='Build the PPM models of this many pairs at once with NumPy')
 
     train_parser = subparsers.add_parser('train',
                                          help='Train a model on prepared data')
@@ -526,6 +1415,11 @@ def main():
                               help='Full path name to the model file')
     apply_parser.add_argument('-r', '--radius', type=float, default=0.05,
                               help='Radius around 0.5 to leave verification cases unanswered')
+    apply_parser.add_argument('-e', '--engine', type=str, default=None,
+                              choices=ENGINES,
+                              help='Distance engine (default: the one stored with the model)')
+    apply_parser.add_argument('-f', '--features', type=str, default='',
+                              help='Features prepared from the evaluation dataset without truth file')
 
     crossval_parser = subparsers.add_parser('crossval',
                                             help='Cross-validate the algorithm on prepared data.')
@@ -537,6 +1431,34 @@ def main():
                                  help='Radius around 0.5 to leave verification cases unanswered')
     crossval_parser.add_argument('-o', '--output', type=str, default='',
                                  help='Name of output file')
+    crossval_parser.add_argument('-j', '--jobs', type=int, default=-1,
+                                 help='Number of parallel processes for folders (-1: all cores)')
+
+    index_parser = subparsers.add_parser('index',
+                                         help='Build the sketch index of a library of texts')
+    index_parser.add_argument('-i', '--input', type=str,
+                              help='JSONL library with one {"id", "text"} per line')
+    index_parser.add_argument('-o', '--output', type=str, default='',
+                              help='Name of output file')
+    index_parser.add_argument('-n', '--ngram', type=int, default=4,
+                              help='Character n-gram length of the sketches')
+    index_parser.add_argument('-s', '--num_perm', type=int, default=128,
+                              help='Number of MinHash permutations')
+
+    search_parser = subparsers.add_parser('search',
+                                          help='Find the library texts most likely by the author of a text')
+    search_parser.add_argument('-i', '--input', type=str,
+                               help='Query text file')
+    search_parser.add_argument('-l', '--index', type=str,
+                               help='Index file built by the index command')
+    search_parser.add_argument('-m', '--model', type=str,
+                               help='Full path name to the model file')
+    search_parser.add_argument('-M', '--top_m', type=int, default=100,
+                               help='Number of candidates kept by the sketch prefilter')
+    search_parser.add_argument('-k', '--top_k', type=int, default=10,
+                               help='Number of results')
+    search_parser.add_argument('-o', '--output', type=str, default='',
+                               help='Path to an output JSON file')
 
     args = parser.parse_args()
 
@@ -545,13 +1467,32 @@ def main():
     os.makedirs(os.path.dirname(os.path.join('data', 'raw/')), exist_ok=True)
 
     if args.command == 'prep':
+        if args.batch_size > 0 and (args.engine != 'ppm' or args.sparse or
+                                    args.sketch_order is not None):
+            print('ERROR: --batch_size only supports the exact ppm engine')
+            parser.exit(1)
+        sketch = None
+        if args.sketch_order is not None:
+            if args.engine != 'ppm' or not 0 <= args.sketch_order <= args.ppm_order:
+                print('ERROR: --sketch_order must be between 0 and --ppm_order '
+                      'and requires the ppm engine')
+                parser.exit(1)
+            sketch = {'sketchOrder': args.sketch_order,
+                      'epsilon': args.sketch_epsilon,
+                      'delta': args.sketch_delta}
+            print('Sketch table per model: %d bytes' %
+                  CountMinSketch(args.sketch_epsilon, args.sketch_delta).memorySize())
         if os.path.isdir(args.train):
             print('Folder detected.')
-            prep_data_dir(args.train, args.truth, args.ppm_order)
+            prep_data_dir(args.train, args.truth, args.ppm_order, args.engine,
+                          sketch, args.sparse, args.batch_size)
         else:
             os.makedirs(os.path.dirname(os.path.join('data', 'prepared/')),
                         exist_ok=True)
-            prep_data(args.train, args.truth, args.output, args.ppm_order)
+            prep_data(args.train, args.truth, out_name=args.output,
+                      ppm_order=args.ppm_order, engine=args.engine,
+                      sketch=sketch, sparse=args.sparse,
+                      batch_size=args.batch_size)
 
     elif args.command == 'train':
         os.makedirs(os.path.dirname(os.path.join('data', 'model/')),
@@ -559,23 +1500,44 @@ def main():
         train_model(args.input, args.output)
 
     elif args.command == 'apply':
-        if not args.input:
-            print('ERROR: The input file is required')
+        if not args.input and not args.features:
+            print('ERROR: The input file or the features file is required')
             parser.exit(1)
         if not args.output:
             print('ERROR: The output folder is required')
             parser.exit(1)
-        apply_model(args.input, args.output, args.model, args.radius)
+        apply_model(args.input, args.output, args.model, args.radius,
+                    args.engine, args.features)
 
     elif args.command == 'crossval':
         if os.path.isdir(args.input):
             print('Folder detected.')
-            crossval_dir(args.input, args.num_folds, args.radius)
+            crossval_dir(args.input, args.num_folds, args.radius, args.jobs)
         else:
             os.makedirs(os.path.dirname(os.path.join('data', 'prepared/')),
                         exist_ok=True)
             crossval(args.input, args.num_folds, args.radius, args.output)
 
+    elif args.command == 'index':
+        os.makedirs(os.path.dirname(os.path.join('data', 'index/')),
+                    exist_ok=True)
+        build_index(args.input, args.output, args.ngram, args.num_perm)
+
+    elif args.command == 'search':
+        if not args.input or not args.index or not args.model:
+            print('ERROR: The query, index and model files are required')
+            parser.exit(1)
+        with open(args.input, 'r') as fp:
+            query = fp.read()
+        found = search(query, args.index, args.model, args.top_m, args.top_k)
+        print(f"Pruned {found['pruned']} of {found['library_size']} texts, "
+              f"scored {found['candidates']} candidates.")
+        for r in found['results']:
+            print(r['id'], r['value'], round(r['jaccard'], 3))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(found, f, indent=4)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Startup checks for the teahan03 command line interface and the PPM
+ differential harness on short texts.
+ Run with:
+    > python -m pytest test_teahan03.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import ppm_harness
+from teahan03 import STARTUP_TARGET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# modules that must only be imported by the subcommands that need them
+HEAVY_MODULES = ['numpy', 'sklearn', 'joblib', 'tqdm', 'pan20_verif_evaluator']
+
+
+def run(*args):
+    return subprocess.run([sys.executable] + list(args), cwd=HERE,
+                          stdout=subprocess.PIPE, check=True)
+
+
+# best of n wall clock times of running python with args
+def best_time(args, n=7):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_no_heavy_top_level_imports():
+    out = run('-c', 'import json, sys, teahan03; print(json.dumps('
+                    'sorted(set(m.split(".")[0] for m in sys.modules))))')
+    loaded = set(json.loads(out.stdout))
+    assert not loaded.intersection(HEAVY_MODULES)
+
+
+def test_help_startup_time():
+    bare = best_time(['-c', 'pass'])
+    cli = best_time(['teahan03.py', '--help'])
+    assert cli - bare <= STARTUP_TARGET, \
+        '--help took %.0f ms over a bare interpreter' % (1000 * (cli - bare))
+
+
+def test_ppm_harness():
+    mismatches, _ = ppm_harness.check((0, 2, 8), length=60, seeds=(0,))
+    assert mismatches == []
+    mismatches, _ = ppm_harness.check_distances((0, 2, 8), length=60,
+                                                seeds=(0,))
+    assert mismatches == []